@@ -1,8 +1,27 @@
+import sys
 import numpy as np
-from typing import List, Dict, Tuple
+from scipy.spatial import cKDTree
+from collections import Counter, OrderedDict, defaultdict
+from typing import List, Dict, Tuple, FrozenSet, Mapping
 from dataclasses import dataclass
+from types import MappingProxyType
 
-@dataclass
+EARTH_RADIUS_KM = 6371.0
+_EMPTY = np.empty(0, dtype=np.int32)
+# До такого числа точек простой перебор быстрее построения KD-дерева
+KDTREE_MIN_POINTS = 400
+# Сколько лучших результатов возвращает search без full=True
+SEARCH_TOP_K = 32
+# С какого числа POI геофильтр в search идет через KD-дерево
+GEO_KDTREE_MIN_POINTS = 256
+# Абсолютный запас радиуса по хорде (~64 м) на погрешность float32-координат
+GEO_CHORD_MARGIN = 1e-5
+# С какого числа POI окупаются импорт numba и компиляция ядра поиска
+NUMBA_MIN_POINTS = 2048
+# Сколько расширенных запросов хранит кэш RouteBuilder
+QUERY_CACHE_SIZE = 1024
+
+@dataclass(slots=True)
 class POI:
     id: int
     name: str
@@ -13,16 +32,101 @@ class POI:
     rating: float
     visit_time: int = 60
 
+def _score_kernel(lats_rad, lons_rad, tok_indptr, tok_data, token_weights, c_lat, c_lon, idx):
+    """Очки по токенам и расстояния в км для POI из idx за один проход"""
+    n = idx.shape[0]
+    scores = np.zeros(n, dtype=np.int32)
+    dists = np.empty(n, dtype=lats_rad.dtype)
+    cos_c = np.cos(c_lat)
+    for j in range(n):
+        i = idx[j]
+        s = 0
+        for k in range(tok_indptr[i], tok_indptr[i+1]):
+            s += token_weights[tok_data[k]]
+        scores[j] = s
+        a = (np.sin((lats_rad[i] - c_lat) / 2) ** 2
+             + cos_c * np.cos(lats_rad[i]) * np.sin((lons_rad[i] - c_lon) / 2) ** 2)
+        dists[j] = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    return scores, dists
+
+_compiled_kernel = None
+
+def _get_score_kernel():
+    """Ядро поиска, скомпилированное numba, или None если numba не установлена"""
+    global _compiled_kernel
+    if _compiled_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:  # numba не обязательна: без нее работает numpy-версия поиска
+            _compiled_kernel = False
+        else:
+            _compiled_kernel = njit(cache=True)(_score_kernel)
+    return _compiled_kernel or None
+
 class RouteBuilder:
     def __init__(self):
         self.pois = self._create_sample_data()
+        for poi in self.pois:
+            # Теги повторяются между POI - храним одну копию каждой строки
+            poi.tags = [sys.intern(str(t)) for t in poi.tags]
         # Синонимы для улучшения поиска
         self.synonyms = {
-            'церковь': ['церковь', 'храм', 'собор', 'часовня'],
-            'монастырь': ['монастырь', 'обитель', 'лавра'],
-            'старый': ['старый', 'древний', 'старинный', 'исторический'],
-            'москва': ['москва', 'московский', 'в москве']
+            key: [sys.intern(s) for s in group] for key, group in (
+                ('церковь', ['церковь', 'храм', 'собор', 'часовня']),
+                ('монастырь', ['монастырь', 'обитель', 'лавра']),
+                ('старый', ['старый', 'древний', 'старинный', 'исторический']),
+                ('москва', ['москва', 'московский', 'в москве']),
+            )
         }
+        # Слово -> его синонимы (без самого слова)
+        self._syn_index: Dict[str, Tuple[str, ...]] = {}
+        for group in self.synonyms.values():
+            for word in group:
+                self._syn_index[word] = self._syn_index.get(word, ()) + tuple(s for s in group if s != word)
+        # Синонимы из нескольких слов ('в москве') ищем как фразы целиком
+        self._phrases: FrozenSet[str] = frozenset(
+            s for group in self.synonyms.values() for s in group if ' ' in s
+        )
+        # Кэш расширения запросов на экземпляр: зависит от self._syn_index
+        self._weights_cache: 'OrderedDict[str, Mapping[str, int]]' = OrderedDict()
+        # Координаты в виде отдельных массивов для векторных расчетов
+        self._lats = np.array([p.latitude for p in self.pois], dtype=np.float32)
+        self._lons = np.array([p.longitude for p in self.pois], dtype=np.float32)
+        self._lats_rad = np.radians(self._lats)
+        self._lons_rad = np.radians(self._lons)
+        # KD-дерево по точкам на единичной сфере: хорда монотонна по дуге, поэтому
+        # радиус по хорде (с запасом на погрешность float32) отбирает надмножество
+        # точек гаверсинуса, а точную проверку делает сам гаверсинус
+        self._tree = None
+        if len(self.pois) >= GEO_KDTREE_MIN_POINTS:
+            self._tree = cKDTree(self._unit_xyz(self._lats_rad.astype(np.float64),
+                                                self._lons_rad.astype(np.float64)))
+        self._is_church = np.array([p.poi_type == 'church' for p in self.pois], dtype=np.int32)
+        self._is_monastery = np.array([p.poi_type == 'monastery' for p in self.pois], dtype=np.int32)
+        self._ratings = np.array([p.rating for p in self.pois], dtype=np.float32)
+        self._rating_score = self._ratings * (2.0 / 5.0)
+        # Обратный индекс: токен -> индексы POI, где он встречается
+        self._poi_tokens: List[FrozenSet[str]] = [
+            frozenset(sys.intern(str(t)) for t in p.name.lower().split())
+            | frozenset(self._find_phrases(p.name.lower().split()))
+            | frozenset(sys.intern(t.lower()) for t in p.tags)
+            for p in self.pois
+        ]
+        postings = defaultdict(list)
+        for i, tokens in enumerate(self._poi_tokens):
+            for token in tokens:
+                postings[token].append(i)
+        self._token_to_pois: Dict[str, np.ndarray] = {
+            token: np.array(idx, dtype=np.int32) for token, idx in postings.items()
+        }
+        # Те же токены в виде CSR (indptr, data) из целочисленных id для numba-ядра
+        self._token_ids: Dict[str, int] = {token: i for i, token in enumerate(postings)}
+        self._tok_indptr = np.zeros(len(self.pois) + 1, dtype=np.int64)
+        self._tok_indptr[1:] = np.cumsum([len(tokens) for tokens in self._poi_tokens])
+        self._tok_data = np.fromiter(
+            (self._token_ids[t] for tokens in self._poi_tokens for t in tokens),
+            dtype=np.int32, count=int(self._tok_indptr[-1])
+        )
     
     def _create_sample_data(self):
         return [
@@ -42,58 +146,110 @@ class RouteBuilder:
                 ["монастырь", "некрополь", "старый", "москва"], 4.4, 90),
         ]
     
-    def _expand_query_words(self, query_words: List[str]) -> List[str]:
-        """Расширяем запрос синонимами"""
-        expanded = []
-        for word in query_words:
-            expanded.append(word)
-            # Добавляем синонимы если они есть
-            for key, synonyms in self.synonyms.items():
-                if word in synonyms:
-                    expanded.extend([s for s in synonyms if s != word])
-        return list(set(expanded))  # Убираем дубли
-    
-    def search(self, query: str, center: Tuple[float, float], radius_km: float = 100) -> List[POI]:
-        """Улучшенный поиск POI"""
-        results = []
-        query_words = query.lower().split()
-        expanded_words = self._expand_query_words(query_words)
+    def _query_weights(self, ql: str) -> Mapping[str, int]:
+        """Веса слов запроса: исходные слова - 2, синонимы - 1 (с кэшем по запросу)"""
+        cached = self._weights_cache.get(ql)
+        if cached is not None:
+            # Популярные запросы поднимаем в конец, чтобы их не вытеснило
+            self._weights_cache.move_to_end(ql)
+            return cached
         
-        for poi in self.pois:
-            # 1. Геофильтр
-            dist = self._distance(center, (poi.latitude, poi.longitude))
-            if dist > radius_km:
-                continue
-            
-            # 2. Поиск по ключевым словам с синонимами
-            score = 0
-            poi_text = f"{poi.name.lower()} {' '.join(poi.tags).lower()}"
-            
-            # Проверяем каждое слово запроса (включая синонимы)
-            for word in expanded_words:
-                if word in poi_text:
-                    # Слово из оригинального запроса дает больше очков
-                    if word in query_words:
-                        score += 2
-                    else:  # Синоним
-                        score += 1
-            
-            # Бонус за тип POI если он упоминается в запросе
-            if any(t in query.lower() for t in ['церковь', 'храм', 'собор']) and poi.poi_type == 'church':
-                score += 1
-            if 'монастырь' in query.lower() and poi.poi_type == 'monastery':
-                score += 1
+        query_words = ql.split()
+        phrases = self._find_phrases(query_words)
+        if phrases:
+            # Слова найденной фразы ('в', 'москве') отдельно не учитываем
+            phrase_words = {w for ph in phrases for w in ph.split()}
+            query_words = [w for w in query_words if w not in phrase_words] + phrases
+        weights = {s: 1 for w in query_words for s in self._syn_index.get(w, ())}
+        weights.update((w, 2) for w in query_words)
+        
+        if len(self._weights_cache) >= QUERY_CACHE_SIZE:
+            # Вытесняем запрос, к которому дольше всего не обращались
+            self._weights_cache.popitem(last=False)
+        self._weights_cache[ql] = MappingProxyType(weights)
+        return self._weights_cache[ql]
+    
+    def _find_phrases(self, words: List[str]) -> List[str]:
+        """Фразы-синонимы, которые встречаются в последовательности слов"""
+        text = f" {' '.join(words)} "
+        return [ph for ph in self._phrases if f" {ph} " in text]
+    
+    def _token_scores(self, weights: Mapping[str, int]) -> np.ndarray:
+        """Очки всех POI по взвешенным токенам запроса"""
+        scores = np.zeros(len(self.pois), dtype=np.int32)
+        for token, weight in weights.items():
+            np.add.at(scores, self._token_to_pois.get(token, _EMPTY), weight)
+        return scores
+    
+    def search(self, query: str, center: Tuple[float, float], radius_km: float = 100,
+               full: bool = False) -> List[POI]:
+        """Улучшенный поиск POI (топ-SEARCH_TOP_K, все совпадения при full=True)"""
+        ql = query.lower()
+        weights = self._query_weights(ql)
+        has_church_kw = any(t in ql for t in ('церковь', 'храм', 'собор'))
+        has_monastery_kw = 'монастырь' in ql
+        
+        n = len(self.pois)
+        kernel = _get_score_kernel() if n >= NUMBA_MIN_POINTS else None
+        
+        # 1. Геофильтр: кандидаты из KD-дерева, гаверсинус только для них
+        cand = None
+        if self._tree is not None:
+            chord = 2 * np.sin(min(radius_km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+            c_xyz = self._unit_xyz(np.radians(center[0]), np.radians(center[1]))
+            cand = np.array(self._tree.query_ball_point(c_xyz, r=chord + GEO_CHORD_MARGIN), dtype=np.intp)
+        
+        if kernel is not None:
+            # 1-2. Расстояния и очки по ключевым словам в скомпилированном ядре
+            idx = cand if cand is not None else np.arange(n, dtype=np.intp)
+            token_weights = np.zeros(len(self._token_ids), dtype=np.int32)
+            for token, weight in weights.items():
+                if token in self._token_ids:
+                    token_weights[self._token_ids[token]] = weight
+            cand_scores, cand_dists = kernel(
+                self._lats_rad, self._lons_rad, self._tok_indptr, self._tok_data,
+                token_weights, np.radians(np.float32(center[0])), np.radians(np.float32(center[1])), idx
+            )
+            scores = np.zeros(n, dtype=np.int32)
+            scores[idx] = cand_scores
+            dists = np.full(n, np.inf, dtype=np.float32)
+            dists[idx] = cand_dists
+        else:
+            if cand is not None:
+                dists = np.full(n, np.inf, dtype=np.float32)
+                dists[cand] = self._haversine_vec(center[0], center[1], cand)
+            else:
+                dists = self._haversine_vec(center[0], center[1])
             
-            if score > 0:
-                # Учитываем расстояние (ближе = лучше) и рейтинг
-                distance_score = max(0, 1 - dist / radius_km) * 2
-                rating_score = poi.rating / 5.0 * 2
-                total_score = score + distance_score + rating_score
-                results.append((poi, total_score, dist))
+            # 2. Поиск по ключевым словам с синонимами через обратный индекс
+            scores = self._token_scores(weights)
+        mask = dists <= radius_km
+        
+        # Бонус за тип POI если он упоминается в запросе
+        scores += int(has_church_kw) * self._is_church + int(has_monastery_kw) * self._is_monastery
         
-        # Сортировка по релевантности
-        results.sort(key=lambda x: x[1], reverse=True)
-        return [p[0] for p in results]
+        # Учитываем расстояние (ближе = лучше) и рейтинг
+        distance_score = np.maximum(0.0, 1.0 - dists / radius_km) * 2.0
+        total_score = scores.astype(np.float32) + distance_score + self._rating_score
+        
+        matched = np.nonzero(mask & (scores > 0))[0]
+        if len(matched) == 0:
+            return []
+        matched_score = total_score[matched]
+        
+        # Сортировка по релевантности: полная или только лучших k
+        if full:
+            order = np.argsort(-matched_score, kind='stable')
+        else:
+            k = min(SEARCH_TOP_K, len(matched))
+            neg = -matched_score
+            kth = np.partition(neg, k - 1)[k - 1]
+            # Равные k-му результату берем в исходном порядке, как при полной сортировке
+            above = np.nonzero(neg < kth)[0]
+            ties = np.nonzero(neg == kth)[0][:k - len(above)]
+            top = np.sort(np.concatenate([above, ties]))
+            order = top[np.argsort(neg[top], kind='stable')]
+        return [self.pois[i] for i in matched[order]]
     
     def create_route(self, pois: List[POI], max_points: int = 4) -> List[POI]:
         """Создание оптимального маршрута"""
@@ -105,20 +261,17 @@ class RouteBuilder:
         
         # 2. Диверсификация по типам (чтобы были не только церкви)
         if len(selected) > 2:
-            types = {}
-            final_selected = []
+            cap = max_points // 2
+            counts = Counter()
+            primary = []
+            spill = []
             
+            # Сверх лимита на тип - в запас, им добираем маршрут в конце
             for poi in selected:
-                if poi.poi_type not in types:
-                    types[poi.poi_type] = 0
-                
-                if types[poi.poi_type] < max_points // 2:
-                    final_selected.append(poi)
-                    types[poi.poi_type] += 1
-                elif len(final_selected) < max_points:
-                    final_selected.append(poi)
+                (primary if counts[poi.poi_type] < cap else spill).append(poi)
+                counts[poi.poi_type] += 1
             
-            selected = final_selected[:max_points]
+            selected = (primary + spill)[:max_points]
         
         # 3. Оптимизируем порядок
         if len(selected) > 1:
@@ -133,38 +286,91 @@ class RouteBuilder:
         
         # Начинаем с точки с наибольшим рейтингом
         start = max(pois, key=lambda p: p.rating)
-        route = [start]
-        unvisited = [p for p in pois if p.id != start.id]
-        
-        while unvisited:
-            last = route[-1]
-            # Находим ближайшую точку
-            next_poi = min(unvisited, 
-                          key=lambda p: self._distance(
-                              (last.latitude, last.longitude),
-                              (p.latitude, p.longitude)
-                          ))
-            route.append(next_poi)
-            unvisited.remove(next_poi)
-        
-        return route
+        if len(pois) > KDTREE_MIN_POINTS:
+            return self._two_opt(self._optimize_order_kdtree(pois, pois.index(start)))
+        
+        lats = np.array([p.latitude for p in pois])
+        lons = np.array([p.longitude for p in pois])
+        alive = np.ones(len(pois), dtype=bool)
+        order = [pois.index(start)]
+        alive[order[0]] = False
+        
+        while alive.any():
+            last = order[-1]
+            # Находим ближайшую непосещенную точку
+            dists = self._haversine_vec_pairs(lats[last], lons[last], lats, lons)
+            dists[~alive] = np.inf
+            order.append(int(np.argmin(dists)))
+            alive[order[-1]] = False
+        
+        return self._two_opt([pois[i] for i in order])
+    
+    def _optimize_order_kdtree(self, pois: List[POI], start: int) -> List[POI]:
+        """Жадный обход ближайших соседей через KD-дерево"""
+        k = len(pois)
+        lats = np.array([p.latitude for p in pois])
+        lons = np.array([p.longitude for p in pois])
+        # Равнопромежуточная проекция, чтобы евклидово расстояние было близко к реальному
+        pts = np.stack([lats, lons * np.cos(np.radians(lats.mean()))], 1)
+        tree = cKDTree(pts)
+        alive = np.ones(k, dtype=bool)
+        alive[start] = False
+        order = [start]
+        
+        for _ in range(1, k):
+            # Берем немного соседей и удваиваем, пока все они уже посещены
+            nn = 8
+            while True:
+                _, idx = tree.query(pts[order[-1]], k=min(nn, k))
+                idx = idx[alive[idx]]
+                if len(idx) or nn >= k:
+                    break
+                nn *= 2
+            cur = int(idx[0])
+            alive[cur] = False
+            order.append(cur)
+        
+        return [pois[i] for i in order]
+    
+    def _two_opt(self, route: List[POI]) -> List[POI]:
+        """Улучшение маршрута перестановками 2-opt (первая точка фиксирована)"""
+        n = len(route)
+        if n <= 3:
+            return route
+        
+        lats = np.array([p.latitude for p in route])
+        lons = np.array([p.longitude for p in route])
+        dmat = self._haversine_vec_pairs(lats[:, None], lons[:, None], lats[None, :], lons[None, :])
+        order = list(range(n))
+        
+        improved = True
+        while improved:
+            improved = False
+            for i in range(1, n - 1):
+                for j in range(i + 1, n):
+                    a, b, c = order[i-1], order[i], order[j]
+                    delta = dmat[a, c] - dmat[a, b]
+                    # Маршрут не замкнут: у последней точки нет следующей
+                    if j < n - 1:
+                        d = order[j+1]
+                        delta += dmat[b, d] - dmat[c, d]
+                    if delta < -1e-9:
+                        order[i:j+1] = order[i:j+1][::-1]
+                        improved = True
+        
+        return [route[i] for i in order]
     
     def calculate_stats(self, route: List[POI]) -> Dict:
         """Расчет статистики маршрута"""
         if not route:
             return {}
         
-        travel_time = 0
         visit_time = sum(p.visit_time for p in route)
-        distance = 0
-        
-        for i in range(len(route)-1):
-            p1 = route[i]
-            p2 = route[i+1]
-            dist = self._distance((p1.latitude, p1.longitude), 
-                                 (p2.latitude, p2.longitude))
-            distance += dist
-            travel_time += dist / 40 * 60  # 40 км/ч
+        lats = np.fromiter((p.latitude for p in route), float, len(route))
+        lons = np.fromiter((p.longitude for p in route), float, len(route))
+        legs = self._haversine_vec_pairs(lats[:-1], lons[:-1], lats[1:], lons[1:])
+        distance = float(legs.sum())
+        travel_time = distance / 40 * 60  # 40 км/ч
         
         total_time = travel_time + visit_time
         
@@ -177,12 +383,42 @@ class RouteBuilder:
             'types': list(set(p.poi_type for p in route))
         }
     
+    def _haversine_vec(self, lat0: float, lon0: float, idx: np.ndarray = None) -> np.ndarray:
+        """Расстояния в км от точки до всех POI (или только до idx) по формуле гаверсинусов"""
+        lats_rad, lons_rad = self._lats_rad, self._lons_rad
+        if idx is not None:
+            lats_rad, lons_rad = lats_rad[idx], lons_rad[idx]
+        lat0, lon0 = np.radians(np.float32(lat0)), np.radians(np.float32(lon0))
+        dlat = lats_rad - lat0
+        dlon = lons_rad - lon0
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat0) * np.cos(lats_rad) * np.sin(dlon / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    
+    @staticmethod
+    def _unit_xyz(lat_rad, lon_rad) -> np.ndarray:
+        """Координаты точек на единичной сфере"""
+        cos_lat = np.cos(lat_rad)
+        return np.stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)], -1)
+    
+    @staticmethod
+    def _haversine_vec_pairs(lat1, lon1, lat2, lon2):
+        """Попарные расстояния в км между массивами точек (в градусах)"""
+        lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    
+    def _distance_to_point(self, poi: POI, point: np.ndarray) -> float:
+        """Расстояние в км от POI до точки (lat, lon) без промежуточных кортежей"""
+        return float(self._haversine_vec_pairs(poi.latitude, poi.longitude, point[0], point[1]))
+    
     @staticmethod
-    def _distance(coord1: Tuple[float, float], coord2: Tuple[float, float]) -> float:
-        """Простой расчет расстояния в км"""
+    def _distance(coord1: Tuple[float, float], coord2: Tuple[float, float], fast: bool = False) -> float:
+        """Расстояние в км (fast=True - грубая оценка, не для ранжирования)"""
         lat1, lon1 = coord1
         lat2, lon2 = coord2
-        return np.sqrt((lat1-lat2)**2 + (lon1-lon2)**2) * 111
+        if fast:
+            return np.sqrt((lat1-lat2)**2 + (lon1-lon2)**2) * 111
+        return RouteBuilder._haversine_vec_pairs(lat1, lon1, lat2, lon2)
 
 def main():
     builder = RouteBuilder()
@@ -196,18 +432,19 @@ def main():
     ]
     
     for query, center, radius in queries:
+        center_arr = np.array(center)
         print(f"\n{'='*50}")
         print(f"🔍 Запрос: '{query}' (радиус: {radius} км)")
         print(f"📍 Центр: {center}")
         
         # 1. Поиск
-        found = builder.search(query, center, radius_km=radius)
+        found = builder.search(query, center, radius_km=radius, full=True)
         print(f"   Найдено мест: {len(found)}")
         
         if found:
             print(f"   Топ-5 найденных:")
             for i, poi in enumerate(found[:5], 1):
-                dist = builder._distance(center, (poi.latitude, poi.longitude))
+                dist = builder._distance_to_point(poi, center_arr)
                 print(f"     {i}. {poi.name} ({poi.poi_type}) - ⭐{poi.rating} - {dist:.1f} км")
         
         # 2. Построение маршрута
@@ -219,7 +456,7 @@ def main():
             
             print(f"\n   📍 МАРШРУТ ({stats['points']} точек, типы: {', '.join(stats['types'])}):")
             for i, poi in enumerate(route, 1):
-                dist_from_center = builder._distance(center, (poi.latitude, poi.longitude))
+                dist_from_center = builder._distance_to_point(poi, center_arr)
                 print(f"      {i}. {poi.name}")
                 print(f"          тип: {poi.poi_type}, ⭐{poi.rating}, ⏱️{poi.visit_time} мин, 📍{dist_from_center:.1f} км")
             